@@ -1,5 +1,8 @@
 #!/usr/bin/env python3 -u
 import argparse
+import ctypes
+import functools
+import hashlib
 import json
 import multiprocessing
 import os
@@ -7,15 +10,21 @@ import platform
 import re
 import shutil
 import subprocess
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
 import boto3
-import pygit2
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
 
-from docs import generate
 from submodules.build_tools.macos.universal import lipo
 from submodules.build_tools.cmake import Config, CMake
+from scripts.git_version import get_git_version
 
 test_report_folder = Path('test-reports')
 test_report_file = Path('ravennakit_test_report.xml')
@@ -26,15 +35,76 @@ ravennakit_benchmarks_target = 'ravennakit_benchmarks'
 script_path = Path(__file__)
 script_dir = script_path.parent
 
-# Git version
-repo = pygit2.Repository(path='.')
-git_version = repo.describe(pattern='v*')
-git_branch = repo.head.shorthand
+# Multipart settings for uploading archives to spaces
+multipart_threshold = 8 * 1024 * 1024
+multipart_chunksize = 64 * 1024 * 1024
+max_parts_in_flight = 4
+spaces_bucket = 'ravennakit'
 
+# Extensions of files which are stored in archives without compressing them (again)
+compressed_suffixes = {'.7z', '.bz2', '.gif', '.gz', '.jpeg', '.jpg', '.png', '.tgz', '.woff', '.woff2', '.xz', '.zip',
+                       '.zst'}
+
+# Files and folders generated by doxygen (and docs/generate.py) inside the docs folder
+docs_outputs = {Path('docs/html'), Path('docs/output'), Path('docs/assets/footer.html')}
+
+# Architectures which are combined into universal macOS binaries
+macos_archs = ['x86_64', 'arm64']
+
+# Android ABIs to build for, and the subfolders to build them in
+android_abis = [('arm64-v8a', 'android_arm64'), ('x86_64', 'android_x64'), ('armeabi-v7a', 'android_arm'),
+                ('x86', 'android_x86')]
+
+# Matches versions described by git (ie. v1.2.3-4-gabcdef)
+version_regex = re.compile(r"^v([0-9]+)\.([0-9]+)\.([0-9]+)(.*)$")
+
+
+@functools.lru_cache(None)
+def git_info():
+    """Returns the version (described by the most recent v* tag) and the branch of the repository."""
+    version = get_git_version()
+    branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], cwd=script_dir,
+                                     text=True).strip()
+    return version, branch
+
+
+class UploadProgress:
+    """Prints the progress of an upload, called from the transfer threads."""
+
+    def __init__(self, file: Path):
+        self._file = file
+        self._size = file.stat().st_size
+        self._uploaded = 0
+        self._reported = -1
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_transferred: int):
+        with self._lock:
+            self._uploaded += bytes_transferred
+            percentage = self._uploaded * 100 // self._size if self._size else 100
+            if percentage // 10 > self._reported // 10:
+                self._reported = percentage
+                print(f'Uploading {self._file.name}: {percentage}% ({self._uploaded}/{self._size} bytes)')
 
-def upload_to_spaces(args, file: Path):
-    session = boto3.session.Session()
 
+def s3_etag(file: Path):
+    """Computes the ETag S3 assigns to the file when uploaded with the multipart settings above."""
+    if file.stat().st_size < multipart_threshold:
+        md5 = hashlib.md5()
+        with open(file, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    part_digests = []
+    with open(file, 'rb') as f:
+        while chunk := f.read(multipart_chunksize):
+            part_digests.append(hashlib.md5(chunk).digest())
+
+    return hashlib.md5(b''.join(part_digests)).hexdigest() + '-' + str(len(part_digests))
+
+
+def spaces_client(args):
     key = args.spaces_key
     secret = args.spaces_secret
 
@@ -44,77 +114,503 @@ def upload_to_spaces(args, file: Path):
     if not secret:
         raise Exception('Need spaces secret')
 
-    client = session.client('s3',
-                            endpoint_url="https://ams3.digitaloceanspaces.com",
-                            region_name="ams3",
-                            aws_access_key_id=key,
-                            aws_secret_access_key=secret)
+    return s3_client(key, secret)
+
 
+@functools.lru_cache(None)
+def s3_client(key: str, secret: str):
+    """
+    Creates the client once and shares it between all uploads. Clients are thread safe and keep a pool of connections,
+    which is sized to serve all concurrent parts of multipart uploads.
+    """
+    config = BotoConfig(max_pool_connections=multiprocessing.cpu_count() * 4,
+                        retries={'mode': 'adaptive', 'max_attempts': 10})
+
+    return boto3.session.Session().client('s3',
+                                          endpoint_url="https://ams3.digitaloceanspaces.com",
+                                          region_name="ams3",
+                                          aws_access_key_id=key,
+                                          aws_secret_access_key=secret,
+                                          config=config)
+
+
+def spaces_file_name(file: Path):
     if branch := os.getenv('CI_COMMIT_BRANCH'):
         folder = 'branches/' + branch
     elif tag := os.getenv('CI_COMMIT_TAG'):
         folder = 'archive/' + tag
     else:
         print('WARNING: Not building on GitLab (no CI_COMMIT_BRANCH or CI_COMMIT_TAG available)')
-        folder = 'local/' + git_branch
+        folder = 'local/' + git_info()[1]
+
+    return folder + '/' + file.name
+
+
+def upload_to_spaces(args, file: Path):
+    client = spaces_client(args)
+    file_name = spaces_file_name(file)
+
+    # Skip the upload when an identical archive is already there (ie. when re-running a build)
+    try:
+        head = client.head_object(Bucket=spaces_bucket, Key=file_name)
+        if head['ETag'].strip('"') == s3_etag(file):
+            print("Artefacts already uploaded to {}/{}, skipping upload".format(spaces_bucket, file_name))
+            return
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+
+    # Large archives are uploaded in parts which are sent concurrently
+    config = TransferConfig(multipart_threshold=multipart_threshold,
+                            multipart_chunksize=multipart_chunksize,
+                            max_concurrency=multiprocessing.cpu_count(),
+                            use_threads=True)
+
+    client.upload_file(str(file), spaces_bucket, file_name, Config=config, Callback=UploadProgress(file))
+
+    print("Uploaded artefacts to {}/{}".format(spaces_bucket, file_name))
+
+
+class StreamingUpload:
+    """
+    Write-only file object which writes to a local file and at the same time uploads the written data to spaces as a
+    multipart upload. Parts are uploaded in the background while the caller keeps writing. The object isn't seekable,
+    which makes zipfile write data descriptors instead of going back to patch the local file headers.
+    """
+
+    def __init__(self, args, file: Path):
+        self._client = spaces_client(args)
+        self._file_name = spaces_file_name(file)
+        self._file = open(file, 'wb')
+        self._buffer = bytearray()
+        self._position = 0
+        self._parts = []
+        self._pool = ThreadPoolExecutor(max_workers=max_parts_in_flight)
+        self._parts_in_flight = threading.BoundedSemaphore(max_parts_in_flight)
+        self._upload_id = self._client.create_multipart_upload(Bucket=spaces_bucket,
+                                                               Key=self._file_name)['UploadId']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+
+        try:
+            self.complete()
+        except Exception:
+            self.abort()
+            raise
+
+    def write(self, data):
+        self._file.write(data)
+        self._buffer += data
+        self._position += len(data)
+
+        while len(self._buffer) >= multipart_chunksize:
+            self._upload_part(bytes(self._buffer[:multipart_chunksize]))
+            del self._buffer[:multipart_chunksize]
+
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        self._file.flush()
+
+    def complete(self):
+        if self._buffer or not self._parts:
+            self._upload_part(bytes(self._buffer))
+            self._buffer.clear()
+
+        self._file.close()
+        parts = [{'ETag': part.result()['ETag'], 'PartNumber': number} for number, part in enumerate(self._parts, 1)]
+        self._pool.shutdown()
+
+        self._client.complete_multipart_upload(Bucket=spaces_bucket, Key=self._file_name, UploadId=self._upload_id,
+                                               MultipartUpload={'Parts': parts})
+
+        print("Uploaded artefacts to {}/{}".format(spaces_bucket, self._file_name))
+
+    def abort(self):
+        self._file.close()
+        self._pool.shutdown(cancel_futures=True)
+        self._client.abort_multipart_upload(Bucket=spaces_bucket, Key=self._file_name, UploadId=self._upload_id)
+
+    def _upload_part(self, data: bytes):
+        # Limits the amount of memory held by parts waiting to be uploaded
+        self._parts_in_flight.acquire()
+        part_number = len(self._parts) + 1
+        future = self._pool.submit(self._client.upload_part, Bucket=spaces_bucket, Key=self._file_name,
+                                   PartNumber=part_number, UploadId=self._upload_id, Body=data)
+        future.add_done_callback(lambda _: self._parts_in_flight.release())
+        self._parts.append(future)
+
+
+# Files which affect configuring, next to the settings passed to CMake
+configure_inputs = [Path('CMakeLists.txt'), Path('CMakePresets.json'), Path('vcpkg.json'), Path('triplets')]
+
+
+@functools.lru_cache(None)
+def configure_inputs_hash():
+    """
+    Returns a hash of the top level CMake and vcpkg files, the triplets and the commits of the submodules (which include
+    vcpkg and its toolchain). A build folder configured for different inputs can't be reused as is.
+    """
+    inputs = hashlib.sha1()
+
+    for path in configure_inputs:
+        path = script_dir / path
+        for file in sorted(path.rglob('*')) if path.is_dir() else [path]:
+            if file.is_file():
+                inputs.update(file.relative_to(script_dir).as_posix().encode())
+                inputs.update(file.read_bytes())
+
+    inputs.update(subprocess.check_output(['git', 'ls-tree', '-r', 'HEAD', 'submodules'], cwd=script_dir))
+    return inputs.hexdigest()
+
+
+@functools.lru_cache(None)
+def sources_hash():
+    """
+    Returns a hash of all tracked files (as staged, including the commits of the submodules), or None when the working
+    tree has changes which the index doesn't reflect.
+    """
+    if subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=script_dir):
+        return None
+
+    return hashlib.sha1(subprocess.check_output(['git', 'ls-files', '-s'], cwd=script_dir)).hexdigest()
+
+
+@functools.lru_cache(None)
+def tool_version(*cmd):
+    """Returns the (version) output of a tool, or an empty string when it can't be run."""
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError:
+        return ''
+
+    return result.stdout + result.stderr
+
+
+class CMakeWithCache(CMake):
+    """
+    Skips configuring when the build folder has been configured before with exactly the same settings. There is no need
+    to configure again in that case, the build step re-runs CMake by itself when any of the CMakeLists.txt changed.
+
+    Skips configuring and building altogether when the build folder has been built before from the same (committed)
+    sources with the same settings and toolchain. The build number is left out, so skipped builds keep the build
+    number they were built with.
+
+    Incremental builds skip configuring whenever the build folder has been configured before, regardless of the settings.
+    """
+
+    def __init__(self, force: bool = False, incremental: bool = False):
+        super().__init__()
+        self._force = force
+        self._incremental = incremental
+        self._build_folder = None
+        self._settings = {}
+
+    def path_to_build(self, path):
+        self._build_folder = Path(path)
+        return super().path_to_build(path)
+
+    def build_config(self, config):
+        self._settings['build_config'] = str(config.value)
+        return super().build_config(config)
+
+    def generator(self, generator):
+        self._settings['generator'] = generator
+        return super().generator(generator)
+
+    def architecture(self, architecture):
+        self._settings['architecture'] = architecture
+        return super().architecture(architecture)
+
+    def option(self, name, value):
+        self._settings['-D' + name] = str(value)
+        return super().option(name, value)
+
+    def toolchain(self):
+        """
+        Returns the versions of the compilers the build folder is configured with (and of Xcode on macOS), or None when
+        the build folder isn't configured.
+        """
+        cache_file = self._build_folder / 'CMakeCache.txt'
+        if not cache_file.exists():
+            return None
+
+        versions = []
+        for line in cache_file.read_text().splitlines():
+            if line.startswith(('CMAKE_C_COMPILER:', 'CMAKE_CXX_COMPILER:')):
+                versions.append(tool_version(line.split('=', 1)[1], '--version'))
+
+        if platform.system() == 'Darwin':
+            versions.append(tool_version('xcodebuild', '-version'))
+
+        return versions
+
+    def build_fingerprint(self):
+        toolchain = self.toolchain()
+        if not sources_hash() or toolchain is None:
+            return None
+
+        settings = sorted((name, value) for name, value in self._settings.items() if name != '-DBUILD_NUMBER')
+        settings += [('sources', sources_hash()), ('toolchain', toolchain)]
+        return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+    def is_built(self):
+        fingerprint = self.build_fingerprint()
+        fingerprint_file = self._build_folder / '.build-fingerprint'
+        return (not self._force and fingerprint is not None and fingerprint_file.exists()
+                and fingerprint_file.read_text() == fingerprint)
+
+    def configure(self):
+        if self.is_built():
+            print(f'{self._build_folder} is built from the same sources already, skipping configure')
+            return
+
+        if self._incremental and (self._build_folder / 'CMakeCache.txt').exists():
+            print(f'{self._build_folder} is configured already, skipping configure for incremental build')
+            return
+
+        settings = sorted(self._settings.items()) + [('inputs', configure_inputs_hash())]
+        fingerprint = hashlib.sha1(repr(settings).encode()).hexdigest()
+        fingerprint_file = self._build_folder / '.configure-fingerprint'
+
+        if (not self._force and (self._build_folder / 'CMakeCache.txt').exists() and fingerprint_file.exists()
+                and fingerprint_file.read_text() == fingerprint):
+            print(f'{self._build_folder} is configured with the same settings already, skipping configure')
+            return
+
+        fingerprint_file.unlink(missing_ok=True)
+
+        # CMake refuses to switch generators in a build folder, so start over when the generator changed
+        cache_file = self._build_folder / 'CMakeCache.txt'
+        if ('generator' in self._settings and cache_file.exists()
+                and f'CMAKE_GENERATOR:INTERNAL={self._settings["generator"]}\n' not in cache_file.read_text()):
+            cache_file.unlink()
+            shutil.rmtree(self._build_folder / 'CMakeFiles', ignore_errors=True)
+
+        super().configure()
+        fingerprint_file.write_text(fingerprint)
+
+    def build(self):
+        if self.is_built():
+            print(f'{self._build_folder} is built from the same sources already, skipping build')
+            return
+
+        fingerprint_file = self._build_folder / '.build-fingerprint'
+        fingerprint_file.unlink(missing_ok=True)
+        super().build()
+
+        fingerprint = self.build_fingerprint()
+        if fingerprint:
+            fingerprint_file.write_text(fingerprint)
+
 
-    bucket = 'ravennakit'
-    file_name = folder + '/' + file.name
-    client.upload_file(str(file), bucket, file_name)
+def use_vcpkg_binary_cache(args, env: dict):
+    """
+    Makes vcpkg store the packages it builds in a cache next to the build folder, at a stable location which CI can
+    persist between jobs (the default cache in the home folder is lost with CI containers). Does nothing when
+    VCPKG_BINARY_SOURCES is set already, for example by CI to use a remote cache.
+    """
+    if 'VCPKG_BINARY_SOURCES' in env:
+        return
 
-    print("Uploaded artefacts to {}/{}".format(bucket, file_name))
+    vcpkg_binary_cache = Path(args.path_to_build).resolve().parent / '.vcpkg-cache'
+    vcpkg_binary_cache.mkdir(parents=True, exist_ok=True)
+    env['VCPKG_BINARY_SOURCES'] = f'clear;files,{vcpkg_binary_cache},readwrite'
+
+
+def use_compiler_cache(args, cmake: CMake, env: dict, distcc: bool = False):
+    """
+    Uses ccache (if installed) as compiler launcher, so that translation units which are the same between variants and
+    runs are not compiled again. The Visual Studio generator ignores compiler launchers, so this does nothing on Windows.
+
+    With distcc, the compilations which miss the cache are sent to the distcc hosts (or all compilations, without ccache).
+    """
+    if distcc and args.distcc_hosts:
+        env['DISTCC_HOSTS'] = args.distcc_hosts
+
+        if not shutil.which('ccache'):
+            cmake.option('CMAKE_C_COMPILER_LAUNCHER', 'distcc')
+            cmake.option('CMAKE_CXX_COMPILER_LAUNCHER', 'distcc')
+            return
+
+        env['CCACHE_PREFIX'] = 'distcc'
+
+    if not shutil.which('ccache'):
+        return
+
+    cmake.option('CMAKE_C_COMPILER_LAUNCHER', 'ccache')
+    cmake.option('CMAKE_CXX_COMPILER_LAUNCHER', 'ccache')
+
+    # Keep the cache next to the build folder, at a stable location which CI can persist between jobs
+    env.setdefault('CCACHE_DIR', str(Path(args.path_to_build).resolve().parent / '.ccache'))
+
+    # Rewrite absolute paths inside the source tree to relative ones, so results are shared between build folders
+    env.setdefault('CCACHE_BASEDIR', str(script_dir.resolve()))
+    env.setdefault('CCACHE_SLOPPINESS', 'pch_defines,time_macros,include_file_mtime')
+
+
+def build_jobs():
+    """
+    Returns the number of jobs to build with: RAV_BUILD_JOBS when set, otherwise the number of CPUs this process may
+    run on (which respects the CPU limits of containers, unlike the number of CPUs in the machine).
+    """
+    if 'RAV_BUILD_JOBS' in os.environ:
+        return max(1, int(os.environ['RAV_BUILD_JOBS']))
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
+def compile_jobs(args, jobs: int = None):
+    """
+    Returns the number of compile jobs for a build getting the given share of the local cores (all by default). With
+    distcc, most jobs run on the distcc hosts, so this returns the same share of their slots instead.
+    """
+    jobs = jobs or build_jobs()
+
+    if not args.distcc_hosts:
+        return jobs
+
+    slots = int(subprocess.check_output(['distcc', '-j'], env={**os.environ, 'DISTCC_HOSTS': args.distcc_hosts},
+                                        text=True))
+    return max(1, slots * jobs // build_jobs())
+
+
+def use_parallel_build(cmake: CMake, env: dict, jobs: int):
+    """
+    Builds using the given number of jobs. Next to passing it to the wrapper, this also sets it in the environment where
+    `cmake --build` and MSBuild pick it up by themselves, so that the build step runs in parallel for every generator.
+    """
+    cmake.parallel(jobs)
+    env['CMAKE_BUILD_PARALLEL_LEVEL'] = str(jobs)
+
+    # Lets MSBuild schedule the compiler invocations of all projects at once, instead of one project at a time
+    env['UseMultiToolTask'] = 'true'
+    env['CL_MPCount'] = str(jobs)
+
+
+def use_job_pools(cmake: CMake, jobs: int):
+    """Runs the given number of compile jobs with Ninja, but limits the number of concurrent (memory hungry) links."""
+    cmake.option('CMAKE_JOB_POOLS', f'compile={jobs};link=2')
+    cmake.option('CMAKE_JOB_POOL_COMPILE', 'compile')
+    cmake.option('CMAKE_JOB_POOL_LINK', 'link')
+
+
+@functools.lru_cache(None)
+def cmake_presets():
+    with open(script_dir / 'CMakePresets.json') as file:
+        return {preset['name']: preset for preset in json.load(file)['configurePresets']}
+
+
+def configure_preset(name: str):
+    """Returns a configure preset from CMakePresets.json, with the settings inherited from other presets merged in."""
+    presets = cmake_presets()
+
+    if name not in presets:
+        raise ValueError(f'Unknown CMake preset {name}')
+
+    preset = presets[name]
+    inherits = preset.get('inherits', [])
+    if isinstance(inherits, str):
+        inherits = [inherits]
+
+    # Presets listed first take precedence over the ones listed later, and the preset itself over all of them
+    resolved = {}
+    cache_variables = {}
+    for settings in [configure_preset(parent) for parent in reversed(inherits)] + [preset]:
+        resolved.update(settings)
+        cache_variables.update(settings.get('cacheVariables', {}))
+
+    resolved['cacheVariables'] = cache_variables
+    return resolved
+
+
+def expand_preset_macros(value: str, env: dict):
+    value = value.replace('${sourceDir}', script_dir.resolve().as_posix())
+    return re.sub(r'\$env\{(\w+)}', lambda match: env.get(match.group(1), ''), value)
+
+
+def apply_preset(cmake: CMake, env: dict, name: str, spdlog: bool = False, asan: bool = False, tsan: bool = False):
+    """
+    Applies the generator, architecture and cache variables of a configure preset to cmake, followed by the presets for
+    the requested variant.
+    """
+    names = [name]
+    if spdlog:
+        names.append('spdlog')
+    if asan:
+        names.append('asan')
+    if tsan:
+        names.append('tsan')
+
+    for preset in map(configure_preset, names):
+        if 'generator' in preset:
+            cmake.generator(preset['generator'])
+        if 'architecture' in preset:
+            cmake.architecture(preset['architecture'])
+        for option, value in preset['cacheVariables'].items():
+            cmake.option(option, expand_preset_macros(value, env))
 
 
 def build_macos_for_arch(args, build_config: Config, path_to_build: Path, arch: str, spdlog: bool = False,
-                         asan: bool = False, tsan: bool = False):
+                         asan: bool = False, tsan: bool = False, jobs: int = None):
     path_to_build = path_to_build / arch
+    # Multi-config generators put binaries in a subfolder per build configuration
+    path_to_binaries = path_to_build / str(build_config.value)
 
     if args.skip_build:
-        return path_to_build
+        return path_to_binaries
 
-    path_to_build.mkdir(parents=True, exist_ok=True)
+    env = os.environ.copy()
 
-    cmake = CMake()
+    cmake = CMakeWithCache(force=args.force_rebuild, incremental=args.incremental)
     cmake.path_to_build(path_to_build)
     cmake.path_to_source(script_dir)
     cmake.build_config(build_config)
-    cmake.generator('Ninja')
-    cmake.parallel(multiprocessing.cpu_count())
+    use_compiler_cache(args, cmake, env, distcc=True)
+    use_vcpkg_binary_cache(args, env)
+    # Fewer jobs when sharing the cores with other builds running at the same time
+    jobs = compile_jobs(args, jobs)
+    use_parallel_build(cmake, env, jobs)
+    cmake.env(env)
+
+    use_job_pools(cmake, jobs)
 
-    triplet = f'macos-{arch.replace("_", "-")}'
+    apply_preset(cmake, env, f'macos-{arch}', spdlog=spdlog, asan=asan, tsan=tsan)
 
-    cmake.option('CMAKE_TOOLCHAIN_FILE', 'submodules/vcpkg/scripts/buildsystems/vcpkg.cmake')
-    cmake.option('VCPKG_OVERLAY_TRIPLETS', 'triplets')
-    cmake.option('VCPKG_TARGET_TRIPLET', triplet)
-    cmake.option('CMAKE_OSX_ARCHITECTURES', arch)
     cmake.option('CMAKE_OSX_DEPLOYMENT_TARGET', args.macos_deployment_target)
-    cmake.option('CMAKE_XCODE_ATTRIBUTE_CODE_SIGN_IDENTITY', 'Apple Development')
-    cmake.option('CMAKE_XCODE_ATTRIBUTE_DEVELOPMENT_TEAM', args.macos_development_team)
-    cmake.option('BUILD_NUMBER', args.build_number)
 
-    cmake.option('RAV_ABORT_ON_ASSERT', 'ON')
-    cmake.option('RAV_BENCHMARKS', 'ON')
-    cmake.option('RAV_ENABLE_DEBUG', 'ON')
+    # Ninja packs the jobs better and is faster to configure, the Xcode project is only needed for signed builds
+    if args.xcode:
+        cmake.generator('Xcode')
+        cmake.option('CMAKE_XCODE_ATTRIBUTE_CODE_SIGN_IDENTITY', 'Apple Development')
+        cmake.option('CMAKE_XCODE_ATTRIBUTE_DEVELOPMENT_TEAM', args.macos_development_team)
 
-    if spdlog:
-        cmake.option('RAV_ENABLE_SPDLOG', 'ON')
-    if asan:
-        cmake.option('RAV_WITH_ADDRESS_SANITIZER', 'ON')
-    if tsan:
-        cmake.option('RAV_WITH_THREAD_SANITIZER', 'ON')
+    cmake.option('BUILD_NUMBER', args.build_number)
 
     cmake.configure()
     cmake.build()
 
-    return path_to_build
+    return path_to_binaries
 
 
-def build_macos(args, build_config: Config, subfolder: str, spdlog: bool = False, asan: bool = False,
-                tsan: bool = False):
-    path_to_build = Path(args.path_to_build) / subfolder
-
-    x86_64 = build_macos_for_arch(args, build_config, path_to_build, 'x86_64', spdlog=spdlog, asan=asan, tsan=tsan)
-    arm64 = build_macos_for_arch(args, build_config, path_to_build, 'arm64', spdlog=spdlog, asan=asan, tsan=tsan)
+def build_macos(args, build_config: Config, path_to_build: Path, spdlog: bool = False, asan: bool = False,
+                tsan: bool = False, jobs: int = None):
+    x86_64 = build_macos_for_arch(args, build_config, path_to_build, 'x86_64', spdlog=spdlog, asan=asan, tsan=tsan,
+                                  jobs=jobs)
+    arm64 = build_macos_for_arch(args, build_config, path_to_build, 'arm64', spdlog=spdlog, asan=asan, tsan=tsan,
+                                 jobs=jobs)
 
     lipo(x86_64, arm64, path_to_build, Path(ravennakit_tests_target))
     lipo(x86_64, arm64, path_to_build, Path(ravennakit_benchmarks_target))
@@ -122,65 +618,52 @@ def build_macos(args, build_config: Config, subfolder: str, spdlog: bool = False
     return path_to_build
 
 
-def build_windows(args, arch, build_config: Config, subfolder: str, spdlog: bool = False):
-    path_to_build = Path(args.path_to_build) / subfolder
-
+def build_windows(args, arch, build_config: Config, path_to_build: Path, spdlog: bool = False, jobs: int = None):
     if args.skip_build:
         return path_to_build
 
-    path_to_build.mkdir(parents=True, exist_ok=True)
+    env = os.environ.copy()
 
-    cmake = CMake()
+    cmake = CMakeWithCache(force=args.force_rebuild, incremental=args.incremental)
     cmake.path_to_build(path_to_build)
     cmake.path_to_source(script_dir)
     cmake.build_config(build_config)
-    cmake.architecture(arch)
-    cmake.parallel(multiprocessing.cpu_count())
+    use_vcpkg_binary_cache(args, env)
+    use_parallel_build(cmake, env, jobs or build_jobs())
+    cmake.env(env)
+
+    apply_preset(cmake, env, f'windows-{arch}', spdlog=spdlog)
 
-    cmake.option('CMAKE_TOOLCHAIN_FILE', 'submodules/vcpkg/scripts/buildsystems/vcpkg.cmake')
-    cmake.option('VCPKG_OVERLAY_TRIPLETS', 'triplets')
-    cmake.option('VCPKG_TARGET_TRIPLET', 'windows-' + arch)
     cmake.option('BUILD_NUMBER', args.build_number)
     cmake.option('RAV_WINDOWS_VERSION', args.windows_version)
 
-    cmake.option('RAV_ABORT_ON_ASSERT', 'ON')
-    cmake.option('RAV_BENCHMARKS', 'ON')
-    cmake.option('RAV_ENABLE_DEBUG', 'ON')
-
-    if spdlog:
-        cmake.option('RAV_ENABLE_SPDLOG', 'ON')
-
     cmake.configure()
     cmake.build()
 
     return path_to_build
 
 
-def build_linux(args, arch, build_config: Config, subfolder: str, spdlog: bool = False):
-    path_to_build = Path(args.path_to_build) / subfolder
-
+def build_linux(args, arch, build_config: Config, path_to_build: Path, spdlog: bool = False, jobs: int = None):
     if args.skip_build:
         return path_to_build
 
-    path_to_build.mkdir(parents=True, exist_ok=True)
+    env = os.environ.copy()
 
-    cmake = CMake()
+    cmake = CMakeWithCache(force=args.force_rebuild, incremental=args.incremental)
     cmake.path_to_build(path_to_build)
     cmake.path_to_source(script_dir)
     cmake.build_config(build_config)
-    cmake.generator('Ninja')
-    cmake.parallel(multiprocessing.cpu_count())
+    use_compiler_cache(args, cmake, env, distcc=True)
+    use_vcpkg_binary_cache(args, env)
+    jobs = compile_jobs(args, jobs)
+    use_parallel_build(cmake, env, jobs)
+    cmake.env(env)
 
-    cmake.option('CMAKE_TOOLCHAIN_FILE', 'submodules/vcpkg/scripts/buildsystems/vcpkg.cmake')
-    cmake.option('VCPKG_TARGET_TRIPLET', arch + '-linux')
-    cmake.option('BUILD_NUMBER', args.build_number)
+    use_job_pools(cmake, jobs)
 
-    cmake.option('RAV_ABORT_ON_ASSERT', 'ON')
-    cmake.option('RAV_BENCHMARKS', 'ON')
-    cmake.option('RAV_ENABLE_DEBUG', 'ON')
+    apply_preset(cmake, env, f'linux-{arch}', spdlog=spdlog)
 
-    if spdlog:
-        cmake.option('RAV_ENABLE_SPDLOG', 'ON')
+    cmake.option('BUILD_NUMBER', args.build_number)
 
     cmake.configure()
     cmake.build()
@@ -188,44 +671,26 @@ def build_linux(args, arch, build_config: Config, subfolder: str, spdlog: bool =
     return path_to_build
 
 
-def build_android(args, arch, build_config: Config, subfolder: str, spdlog: bool = False):
-    path_to_build = Path(args.path_to_build) / subfolder
-
+def build_android(args, arch, build_config: Config, path_to_build: Path, spdlog: bool = False, jobs: int = None):
     if args.skip_build:
         return path_to_build
 
-    android_abi_vcpkg_triplets = {"arm64-v8a": "arm64-android", "armeabi-v7a": "arm-android", "x86_64": "x64-android",
-                                  "x86": "x86-android"}
-
-    triplet = android_abi_vcpkg_triplets[arch]
-
-    if triplet is None:
-        raise ValueError(f'Unknown android architecture {arch}')
-
     android_ndk_home = Path.home() / 'Library' / 'Android' / 'sdk' / 'ndk' / '23.1.7779620'
     env = os.environ.copy()
     env['ANDROID_NDK_HOME'] = str(android_ndk_home)
 
-    path_to_build.mkdir(parents=True, exist_ok=True)
-
-    cmake = CMake()
-    cmake.env(env)
+    cmake = CMakeWithCache(force=args.force_rebuild, incremental=args.incremental)
     cmake.path_to_build(path_to_build)
     cmake.path_to_source(script_dir)
     cmake.build_config(build_config)
-    cmake.parallel(multiprocessing.cpu_count())
-
-    cmake.option('CMAKE_TOOLCHAIN_FILE', 'submodules/vcpkg/scripts/buildsystems/vcpkg.cmake')
-    cmake.option('VCPKG_CHAINLOAD_TOOLCHAIN_FILE', f'{android_ndk_home}/build/cmake/android.toolchain.cmake')
-    cmake.option('VCPKG_TARGET_TRIPLET', triplet)
-    cmake.option('ANDROID_ABI', arch)
-    cmake.option('ANDROID_PLATFORM', 'android-29')
-    cmake.option('BUILD_NUMBER', args.build_number)
+    use_compiler_cache(args, cmake, env)
+    use_vcpkg_binary_cache(args, env)
+    use_parallel_build(cmake, env, jobs or build_jobs())
+    cmake.env(env)
 
-    if spdlog:
-        cmake.option('RAV_ENABLE_SPDLOG', 'ON')
+    apply_preset(cmake, env, f'android-{arch}', spdlog=spdlog)
 
-    cmake.option('RAV_ENABLE_DEBUG', 'ON')
+    cmake.option('BUILD_NUMBER', args.build_number)
 
     cmake.configure()
     cmake.build()
@@ -233,33 +698,119 @@ def build_android(args, arch, build_config: Config, subfolder: str, spdlog: bool
     return path_to_build
 
 
+@functools.lru_cache(None)
+def libc():
+    return ctypes.CDLL(None, use_errno=True)
+
+
+def clone_file(src, dst):
+    """
+    Copy function for shutil.copytree which clones files (reflink on Linux, clonefile on macOS) so that the copy shares
+    its data with the source until either is modified. Falls back to a regular copy if the filesystem doesn't support it.
+    """
+    if platform.system() == 'Linux':
+        import fcntl
+        ficlone = 0x40049409
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), ficlone, src_file.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    elif platform.system() == 'Darwin':
+        # clonefile refuses to overwrite existing files
+        Path(dst).unlink(missing_ok=True)
+        if libc().clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0:
+            return dst
+
+    return shutil.copy2(src, dst)
+
+
+def make_zip(zip_file, root_dir: Path):
+    """
+    Creates a zip archive of the contents of root_dir in zip_file, which is either a path or a writable file object.
+    Unlike shutil.make_archive this doesn't change the working directory, so multiple archives can be created
+    concurrently. When 7-Zip is installed it is used to create archives on disk, since it deflates using all cores.
+    """
+    seven_zip = shutil.which('7z') or shutil.which('7zz')
+
+    if seven_zip and isinstance(zip_file, Path):
+        zip_file.unlink(missing_ok=True)  # 7-Zip would otherwise add to the existing archive
+        subprocess.run([seven_zip, 'a', '-tzip', '-mx=5', '-mmt=on', '-bso0', '-bsp0', str(zip_file.resolve()), '*'],
+                       cwd=root_dir, check=True)
+        return
+
+    with zipfile.ZipFile(zip_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as archive:
+        for dir_path, dir_names, file_names in os.walk(root_dir):
+            dir_names.sort()
+            relative_dir = Path(dir_path).relative_to(root_dir)
+
+            if relative_dir != Path('.'):
+                archive.write(dir_path, relative_dir.as_posix())
+
+            for file_name in sorted(file_names):
+                file = Path(dir_path) / file_name
+                # Files which are compressed already don't get any smaller from deflating them again
+                compress_type = zipfile.ZIP_STORED if file.suffix.lower() in compressed_suffixes else None
+                archive.write(file, (relative_dir / file_name).as_posix(), compress_type=compress_type)
+
+
+def make_zip_and_upload(args, zip_path: Path, root_dir: Path):
+    """Creates the zip like make_zip() while uploading it to spaces, which overlaps compressing with uploading."""
+    with StreamingUpload(args, zip_path) as upload:
+        make_zip(upload, root_dir)
+
+
+def docs_fingerprint(git_version: str):
+    """Returns a hash of everything the docs are generated from: the doxygen inputs and the version in the footer."""
+    digest = hashlib.blake2b(git_version.encode())
+
+    for folder in ['docs', 'include', 'examples']:
+        for dir_path, dir_names, file_names in os.walk(folder):
+            dir_names[:] = sorted(name for name in dir_names if Path(dir_path, name) not in docs_outputs)
+
+            for file_name in sorted(file_names):
+                file = Path(dir_path) / file_name
+                if file not in docs_outputs:
+                    digest.update(file.as_posix().encode())
+                    digest.update(file.read_bytes())
+
+    return digest.hexdigest()
+
+
 def build_dist(args):
+    # Imported here because only the dist build needs it
+    from docs import generate
+
+    git_version, _ = git_info()
     path_to_dist = Path(args.path_to_build) / 'dist'
-    path_to_dist.mkdir(parents=True, exist_ok=True)
 
-    # Generate html docs
-    subprocess.run(['doxygen', 'Doxyfile'], cwd=Path('docs'), check=True)
+    # Generate html docs, unless they have been generated from the same sources before
+    docs_stamp = Path(args.path_to_build) / '.doxygen.stamp'
+    fingerprint = docs_fingerprint(git_version)
 
-    generate.doxygen_docs()
+    if Path('docs/html').is_dir() and docs_stamp.exists() and docs_stamp.read_text() == fingerprint:
+        print('Docs are up to date, skipping doxygen')
+    else:
+        docs_stamp.unlink(missing_ok=True)
+        generate.doxygen_docs(git_version)
+        docs_stamp.write_text(fingerprint)
 
     # Manually choose the files to copy to prevent accidental leaking of files when the repo changes or is not clean.
 
-    shutil.copytree('cmake', path_to_dist / 'cmake', dirs_exist_ok=True)
-    shutil.copytree('docs', path_to_dist / 'docs', dirs_exist_ok=True)
-    shutil.copytree('examples', path_to_dist / 'examples', dirs_exist_ok=True)
-    shutil.copytree('include', path_to_dist / 'include', dirs_exist_ok=True)
-    shutil.copytree('src', path_to_dist / 'src', dirs_exist_ok=True)
-    shutil.copytree('test', path_to_dist / 'test', dirs_exist_ok=True)
-    shutil.copytree('triplets', path_to_dist / 'triplets', dirs_exist_ok=True)
-    shutil.copytree('submodules/vcpkg', path_to_dist / 'submodules/vcpkg', dirs_exist_ok=True)
-    shutil.copy2('.clang-format', path_to_dist)
-    shutil.copy2('.gitignore', path_to_dist)
-    shutil.copy2('CMakeLists.txt', path_to_dist)
-    shutil.copy2('LICENSE', path_to_dist)
-    shutil.copy2('LICENSE-COMMERCIAL.md', path_to_dist)
-    shutil.copy2('README.md', path_to_dist)
-    shutil.copy2('CHANGELOG.md', path_to_dist)
-    shutil.copy2('vcpkg.json', path_to_dist)
+    dist_folders = ['cmake', 'docs', 'examples', 'include', 'src', 'test', 'triplets', 'submodules/vcpkg']
+    dist_files = ['.clang-format', '.gitignore', 'CMakeLists.txt', 'CMakePresets.json', 'LICENSE',
+                  'LICENSE-COMMERCIAL.md', 'README.md', 'CHANGELOG.md', 'vcpkg.json']
+
+    # The copies are independent and I/O bound, so run them concurrently
+    with ThreadPoolExecutor(max_workers=multiprocessing.cpu_count()) as pool:
+        futures = [pool.submit(shutil.copytree, folder, path_to_dist / folder, copy_function=clone_file,
+                               dirs_exist_ok=True) for folder in dist_folders]
+        futures += [pool.submit(clone_file, file, path_to_dist / file) for file in dist_files]
+
+        for future in as_completed(futures):
+            future.result()
 
     version_data = {
         "version": git_version,
@@ -270,107 +821,196 @@ def build_dist(args):
     with open(path_to_dist / 'version.json', 'w') as file:
         json.dump(version_data, file, indent=4)
 
-    match = re.match(r"^v([0-9]+)\.([0-9]+)\.([0-9]+)(.*)$", git_version)
+    match = version_regex.match(git_version)
 
     if not match:
         raise ValueError(f'Invalid version {git_version}')
 
-    with open(path_to_dist / 'cmake/version.cmake', 'w') as file:
-        file.write(f'set(GIT_DESCRIBE_VERSION "{git_version}")\n')
-        file.write(f'set(GIT_VERSION_MAJOR {match.group(1)})\n')
-        file.write(f'set(GIT_VERSION_MINOR {match.group(2)})\n')
-        file.write(f'set(GIT_VERSION_PATCH {match.group(3)})\n')
-        file.write(f'set(BUILD_NUMBER {args.build_number})\n')
+    # Write to a temporary file first, so the version file is replaced in one go
+    version_cmake = path_to_dist / 'cmake' / 'version.cmake'
+    version_cmake_tmp = version_cmake.with_suffix('.cmake.tmp')
+    version_cmake_tmp.write_text(f'set(GIT_DESCRIBE_VERSION "{git_version}")\n'
+                                 f'set(GIT_VERSION_MAJOR {match.group(1)})\n'
+                                 f'set(GIT_VERSION_MINOR {match.group(2)})\n'
+                                 f'set(GIT_VERSION_PATCH {match.group(3)})\n'
+                                 f'set(BUILD_NUMBER {args.build_number})\n')
+    os.replace(version_cmake_tmp, version_cmake)
 
-    # Create docs zip
-    archive_path = args.path_to_build + '/ravennakit-' + git_version + '-' + args.build_number + '-docs'
-    zip_path = Path(archive_path + '.zip')
-    zip_path.unlink(missing_ok=True)
-    shutil.make_archive(archive_path, 'zip', path_to_dist / 'docs' / 'html')
+    archive_name = 'ravennakit-' + git_version + '-' + args.build_number
+    docs_zip_path = Path(args.path_to_build) / (archive_name + '-docs.zip')
+    dist_zip_path = Path(args.path_to_build) / (archive_name + '-dist.zip')
 
-    # Create dist zip
-    archive_path = args.path_to_build + '/ravennakit-' + git_version + '-' + args.build_number + '-dist'
-    zip_path = Path(archive_path + '.zip')
-    zip_path.unlink(missing_ok=True)
-    shutil.make_archive(archive_path, 'zip', path_to_dist)
+    # zlib releases the GIL while compressing, which allows creating the docs and dist zips in parallel
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(make_zip, docs_zip_path, path_to_dist / 'docs' / 'html')]
 
-    return zip_path  # Only returning the dist package since that is the one we want to upload
+        if args.upload and args.stream_upload:
+            futures.append(pool.submit(make_zip_and_upload, args, dist_zip_path, path_to_dist))
+        else:
+            futures.append(pool.submit(make_zip, dist_zip_path, path_to_dist))
 
+        for future in as_completed(futures):
+            future.result()
 
-def build(args):
-    build_config = Config.debug if args.debug else Config.release_with_debug_info
+    return dist_zip_path  # Only returning the dist package since that is the one we want to upload
 
-    test_report_folder.mkdir(parents=True, exist_ok=True)
 
-    archive = None
+def build_variants(build_variant, variants: list, paths: dict, workers: int = None, **kwargs):
+    """
+    Builds the variants at the same time (in their own folders, sharing the cores) using the given build function, and
+    returns what it returns for each of the variants.
+    """
+    workers = workers or len(variants)
+    jobs = max(1, build_jobs() // workers)
 
-    def run_test(test_target, report_name):
-        print(f'Running test {report_name} ({test_target})')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(build_variant, path_to_build=paths[subfolder], jobs=jobs, **kwargs, **options)
+                   for subfolder, options in variants]
 
-        cmd = [test_target, '--reporter',
-               f'JUnit::out={test_report_folder}/{report_name}.xml', '--reporter',
-               'console::out=-::colour-mode=ansi']
-        subprocess.run(cmd, check=True)
+    return [future.result() for future in futures]
 
-        if platform.system() == 'Darwin' and platform.processor() == 'arm':
-            print(f'Running x86_64 test {report_name} ({test_target})')
-            subprocess.run(['arch', '--x86_64'] + cmd, check=True)
+
+def build(args):
+    build_config = Config.debug if args.debug else Config.release_with_debug_info
+    path_to_build = Path(args.path_to_build)
+
+    # The variants to build for this platform as (subfolder, options), and the folders they need
+    variants = []
+    folders = [test_report_folder]
 
     if args.dist:
-        archive = build_dist(args)
+        folders.append(path_to_build / 'dist')
+    elif platform.system() == 'Darwin' and args.android:
+        for arch, subfolder in android_abis:
+            variants.append((subfolder, {'arch': arch}))
+            variants.append((subfolder + '_spdlog', {'arch': arch, 'spdlog': True}))
+    elif platform.system() == 'Darwin':
+        variants.append(('macos_universal', {}))
+
+        if args.asan:
+            variants.append(('macos_universal_spdlog_asan', {'spdlog': True, 'asan': True}))
+
+        if args.tsan:
+            variants.append(('macos_universal_spdlog_tsan', {'spdlog': True, 'tsan': True}))
+    elif platform.system() == 'Windows':
+        variants.append(('windows_x64', {'arch': 'x64'}))
+        variants.append(('windows_x64_spdlog', {'arch': 'x64', 'spdlog': True}))
+    elif platform.system() == 'Linux':
+        variants.append(('linux_x64', {'arch': 'x64'}))
+        variants.append(('linux_x64_spdlog', {'arch': 'x64', 'spdlog': True}))
+        # TODO: variants.append(('linux_arm64', {'arch': 'arm64'}))
+
+    # The build folder of each variant, determined once for creating and building them
+    paths = {subfolder: path_to_build / subfolder for subfolder, _ in variants}
+
+    if platform.system() == 'Darwin' and not args.android:
+        # Universal binaries are combined from a build per architecture
+        folders += [path / arch for path in paths.values() for arch in macos_archs]
     else:
-        if platform.system() == 'Darwin':
-            if args.android:
-                path_to_build = build_android(args, 'arm64-v8a', build_config, 'android_arm64')
-                path_to_build = build_android(args, 'arm64-v8a', build_config, 'android_arm64_spdlog', spdlog=True)
+        folders += paths.values()
 
-                path_to_build = build_android(args, 'x86_64', build_config, 'android_x64')
-                path_to_build = build_android(args, 'x86_64', build_config, 'android_x64_spdlog', spdlog=True)
+    # Create all folders up front, instead of every (concurrently running) build creating its own
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
 
-                path_to_build = build_android(args, 'armeabi-v7a', build_config, 'android_arm')
-                path_to_build = build_android(args, 'armeabi-v7a', build_config, 'android_arm_spdlog', spdlog=True)
+    archive = None
 
-                path_to_build = build_android(args, 'x86', build_config, 'android_x86')
-                path_to_build = build_android(args, 'x86', build_config, 'android_x86_spdlog', spdlog=True)
+    # Random test order exposes tests depending on each other. It's seeded by the build number (or a hash of it, when it
+    # isn't a number), so a failing order can be reproduced.
+    build_number = str(args.build_number)
+    if build_number.isdigit():
+        rng_seed = int(build_number) % 2 ** 32
+    else:
+        rng_seed = int(hashlib.sha1(build_number.encode()).hexdigest()[:8], 16)
+
+    def run_test(test_target, report_name, last=False):
+        def test_cmd(report_file_name):
+            # CI can split the tests over several jobs using RAV_SHARD_INDEX and RAV_SHARD_COUNT
+            return [test_target, '--reporter', f'JUnit::out={test_report_folder}/{report_file_name}.xml',
+                    '--reporter', 'console::out=-::colour-mode=ansi',
+                    '--order', 'rand', '--rng-seed', str(rng_seed),
+                    '--shard-index', os.environ.get('RAV_SHARD_INDEX', '0'),
+                    '--shard-count', os.environ.get('RAV_SHARD_COUNT', '1')]
+
+        # On Apple Silicon also run the x86_64 tests (under Rosetta), after the arm64 tests. Not at the same time, as some
+        # tests listen on fixed ports.
+        if platform.system() == 'Darwin' and platform.processor() == 'arm':
+            runs = [(f'{report_name}_arm64', test_cmd(f'{report_name}_arm64')),
+                    (f'{report_name}_x86_64', ['arch', '--x86_64'] + test_cmd(f'{report_name}_x86_64'))]
+        else:
+            runs = [(report_name, test_cmd(report_name))]
+
+        print(f'Running test {report_name} ({test_target}) with --rng-seed {rng_seed}', flush=True)
+
+        # Nothing is left to do after the last test, so (where exec is native) this process is replaced by the test.
+        # Signals then go straight to the test and its exit code becomes the exit code of the build. Without this process
+        # its output can't be condensed, which the --help epilog points out.
+        if last and len(runs) == 1 and os.name == 'posix':
+            cmd = [str(part) for part in runs[0][1]]
+            os.execv(cmd[0], cmd)
+
+        # The console output goes to a file, which is only printed in full when the tests fail
+        failed = None
+
+        for name, cmd in runs:
+            with tempfile.TemporaryFile() as output:
+                process = subprocess.run(cmd, stdout=output, stderr=subprocess.STDOUT)
+                output.seek(0)
+                lines = output.read().decode(errors='replace').rstrip().splitlines()
+
+            if process.returncode != 0:
+                print(f'Test {name} failed:')
+                print('\n'.join(lines))
+                failed = failed or subprocess.CalledProcessError(process.returncode, process.args)
             else:
-                path_to_build = build_macos(args, build_config, 'macos_universal')
-                run_test(path_to_build / ravennakit_tests_target, 'macos_universal')
-                subprocess.run([path_to_build / ravennakit_benchmarks_target], check=True)
-
-                if args.asan:
-                    path_to_build = build_macos(args, build_config, 'macos_universal_spdlog_asan', spdlog=True,
-                                                asan=True)
-                    run_test(path_to_build / ravennakit_tests_target, 'macos_universal_spdlog_asan')
+                print(f'Test {name}: {lines[-1] if lines else "no output"}')
 
-                if args.tsan:
-                    path_to_build = build_macos(args, build_config, 'macos_universal_spdlog_tsan', spdlog=True,
-                                                tsan=True)
-                    run_test(path_to_build / ravennakit_tests_target, 'macos_universal_spdlog_tsan')
+        if failed:
+            raise failed
 
-        elif platform.system() == 'Windows':
-            path_to_build = build_windows(args, 'x64', build_config, 'windows_x64')
-            run_test(path_to_build / str(build_config.value) / f'{ravennakit_tests_target}.exe', 'windows_x64')
-            subprocess.run([path_to_build / str(build_config.value) / ravennakit_benchmarks_target], check=True)
-
-            path_to_build = build_windows(args, 'x64', build_config, 'windows_x64_spdlog', spdlog=True)
-            run_test(path_to_build / str(build_config.value) / f'{ravennakit_tests_target}.exe', 'windows_x64_spdlog')
-
-        elif platform.system() == 'Linux':
-            path_to_build = build_linux(args, 'x64', build_config, 'linux_x64')
-            run_test(path_to_build / ravennakit_tests_target, 'linux_x64')
-            subprocess.run([path_to_build / ravennakit_benchmarks_target], check=True)
-
-            path_to_build = build_linux(args, 'x64', build_config, 'linux_x64_spdlog', spdlog=True)
-            run_test(path_to_build / ravennakit_tests_target, 'linux_x64_spdlog')
+    if args.dist:
+        archive = build_dist(args)
+    elif platform.system() == 'Darwin' and args.android:
+        # There are many ABIs and variants, so build a few of them at a time
+        build_variants(build_android, variants, paths, workers=max(1, min(4, build_jobs() // 2)), args=args,
+                       build_config=build_config)
+    elif platform.system() == 'Darwin':
+        # Run the tests one by one after building
+        paths_to_build = build_variants(build_macos, variants, paths, args=args, build_config=build_config)
+
+        for index, ((subfolder, _), path_to_variant) in enumerate(zip(variants, paths_to_build)):
+            last = index == len(variants) - 1 and subfolder != 'macos_universal'
+            run_test(path_to_variant / ravennakit_tests_target, subfolder, last=last)
+
+            if subfolder == 'macos_universal':
+                subprocess.run([path_to_variant / ravennakit_benchmarks_target], check=True)
+    elif platform.system() in ('Windows', 'Linux'):
+        build_variant = build_windows if platform.system() == 'Windows' else build_linux
+
+        # Run the tests one by one after building
+        paths_to_build = build_variants(build_variant, variants, paths, args=args, build_config=build_config)
+
+        for index, ((subfolder, _), path_to_variant) in enumerate(zip(variants, paths_to_build)):
+            if platform.system() == 'Windows':
+                path_to_variant = path_to_variant / str(build_config.value)
+                run_test(path_to_variant / f'{ravennakit_tests_target}.exe', subfolder)
+            else:
+                last = index == len(variants) - 1 and subfolder != 'linux_x64'
+                run_test(path_to_variant / ravennakit_tests_target, subfolder, last=last)
 
-            # TODO: path_to_build_arm64 = build_linux(args, 'arm64', build_config)
+            if subfolder in ('windows_x64', 'linux_x64'):
+                subprocess.run([path_to_variant / ravennakit_benchmarks_target], check=True)
 
-    if archive and args.upload:
+    if archive and args.upload and not args.stream_upload:
         upload_to_spaces(args, archive)
 
 
 def main():
-    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     epilog="Test runs only print their summary, unless they fail. The exception is the "
+                                            "last test run on Linux and Intel Macs: it replaces this script (so that "
+                                            "signals and its exit code go straight to and from the tests) and "
+                                            "therefore prints its full output.")
 
     parser.add_argument("--debug",
                         help="Enable debug builds",
@@ -392,10 +1032,28 @@ def main():
                         help="Skip building",
                         action='store_true')
 
+    parser.add_argument("--force-rebuild",
+                        help="Configure and build, even when built from the same sources before. Without it, such "
+                             "builds are skipped and their binaries keep the build number they were built with",
+                        action='store_true')
+
+    parser.add_argument("--incremental",
+                        help="Only build, without configuring again when the build folder is configured already",
+                        action='store_true')
+
+    parser.add_argument("--distcc-hosts",
+                        help="Distribute the compilations over these distcc hosts, in the DISTCC_HOSTS format "
+                             "(macOS and Linux only)")
+
     parser.add_argument("--upload",
                         help="Upload the archive to spaces",
                         action='store_true')
 
+    parser.add_argument("--stream-upload",
+                        help="Upload the dist archive while it is being created, instead of after. This skips the check "
+                             "for an identical archive which was uploaded before.",
+                        action='store_true')
+
     parser.add_argument("--spaces-key",
                         help="Specify the key for uploading to spaces")
 
@@ -415,6 +1073,10 @@ def main():
                             help="Build and run with thread sanitizer (separately)",
                             action="store_true")
 
+        parser.add_argument("--xcode",
+                            help="Build using the Xcode generator instead of Ninja, for signed builds",
+                            action="store_true")
+
         parser.add_argument("--notarize",
                             help="Notarize packages",
                             action="store_true")
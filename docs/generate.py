@@ -1,33 +1,22 @@
 # Script location matters, cwd does not
 import subprocess
+import sys
 from pathlib import Path
 
-import pygit2
-
 script_path = Path(__file__)
 script_dir = script_path.parent
 
-# Git version
-repo = pygit2.Repository(path='.')
-git_version = repo.describe(pattern='v*')
-git_branch = repo.head.shorthand
-
 
 def replace_in_file(source_file, destination_file, old_string, new_string):
-    with open(source_file, "r", encoding="utf-8") as file:
-        content = file.read()
-
-    # Replace occurrences of the old string with the new string
-    content = content.replace(old_string, new_string)
-
-    # Write the modified content to the destination file
-    with open(destination_file, "w", encoding="utf-8") as file:
-        file.write(content)
+    # Replace occurrences of the old string with the new string line by line, while writing to the destination file
+    with open(source_file, "r", encoding="utf-8") as source, open(destination_file, "w", encoding="utf-8") as dest:
+        for line in source:
+            dest.write(line.replace(old_string, new_string))
 
     print(f"Replaced '{old_string}' with '{new_string}' and saved to {destination_file}")
 
 
-def doxygen_docs():
+def doxygen_docs(git_version):
     replace_in_file(script_dir / 'assets' / 'footer.html.template',
                     script_dir / 'assets' / 'footer.html',
                     '%CUSTOM_FOOTER_TEXT%', f'RAVENNAKIT version {git_version}')
@@ -36,5 +25,9 @@ def doxygen_docs():
 
 
 if __name__ == '__main__':
+    # Makes the shared helpers in scripts/ importable when running this file directly
+    sys.path.insert(0, str(script_dir.parent / 'scripts'))
+    from git_version import get_git_version
+
     print("Invoke {} as script. Script dir: {}".format(script_path, script_dir))
-    doxygen_docs()
+    doxygen_docs(get_git_version())
@@ -0,0 +1,21 @@
+import os
+import subprocess
+from pathlib import Path
+
+# Script location matters, cwd does not
+script_dir = Path(__file__).parent
+
+
+def get_git_version():
+    """
+    Returns the version described by the most recent v* tag. The result is kept in the RAV_GIT_VERSION environment
+    variable, so that it is determined only once for a script and the scripts it runs (and CI can pass it on).
+    """
+    git_version = os.environ.get('RAV_GIT_VERSION')
+
+    if not git_version:
+        git_version = subprocess.check_output(['git', 'describe', '--match', 'v*'], cwd=script_dir,
+                                              text=True).strip()
+        os.environ['RAV_GIT_VERSION'] = git_version
+
+    return git_version
@@ -1,37 +1,61 @@
 import argparse
+import contextlib
 import glob
+import shlex
 import subprocess
+import tempfile
+import zipfile
 from pathlib import Path
 
-import pygit2
-
-# Git version
-repo = pygit2.Repository(path='.')
-git_version = repo.describe(pattern='v*')
-git_branch = repo.head.shorthand
+from git_version import get_git_version
 
 script_path = Path(__file__)
 script_dir = script_path.parent
 
 
-def upload_docs_using_sftp(args):
+@contextlib.contextmanager
+def ssh_master_connection(remote, ssh_port):
+    """
+    Opens an ssh master connection in the background and yields the ssh options to share it, so that the following ssh
+    (and rsync) invocations don't each set up a connection of their own. The master connection is closed on exit.
+    """
+    # Unix socket paths are limited to ~104 bytes, which the (long) temporary folder on macOS can exceed
+    with tempfile.TemporaryDirectory(dir='/tmp') as control_dir:
+        ssh_options = ['-p', str(ssh_port), '-o', f'ControlPath={control_dir}/%C']
+        subprocess.run(['ssh', *ssh_options, '-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes', '-N', '-f', remote],
+                       check=True)
+        try:
+            yield ssh_options
+        finally:
+            subprocess.run(['ssh', *ssh_options, '-O', 'exit', remote])
+
+
+def upload_docs_using_rsync(args):
     files = glob.glob(str(args.path_to_build) + '/*-docs.zip')
-    if files is None:
+    if not files:
         print("No files found")
         return
 
-    tmp_file_name = f'docs_{git_version}.zip'
+    git_version = get_git_version()
+    remote = f'{args.username}@{args.hostname}'
+
+    with tempfile.TemporaryDirectory() as docs_dir, ssh_master_connection(remote, args.ssh_port) as ssh_options:
+        with zipfile.ZipFile(files[0]) as docs_zip:
+            docs_zip.extractall(docs_dir)
 
-    scp_cmd = ['scp', '-P', f'{args.ssh_port}', '-r', files[0],
-               f'{args.username}@{args.hostname}:{args.remote_path}/{tmp_file_name}']
-    ssh_cmd = ['ssh', f'{args.username}@{args.hostname}', '-p', args.ssh_port,
-               f'mkdir -p {args.remote_path}/{git_version} && unzip -o {args.remote_path}/{tmp_file_name} -d {args.remote_path}/{git_version} && rm {args.remote_path}/{tmp_file_name} && ln -sfn {args.remote_path}/{git_version} {args.remote_path}/latest']
+        # Files which didn't change since the latest version are hard linked on the server instead of transferred again.
+        # Doxygen rewrites all files and extracting gives them new modification times, so compare the contents instead.
+        rsync_cmd = ['rsync', '-az', '--checksum', '--partial', '--delete-after', '--link-dest=../latest',
+                     '-e', shlex.join(['ssh', *ssh_options]),
+                     f'{docs_dir}/', f'{remote}:{args.remote_path}/{git_version}/']
+        ssh_cmd = ['ssh', *ssh_options, remote,
+                   f'ln -sfn {args.remote_path}/{git_version} {args.remote_path}/latest']
 
-    print(f"{' '.join(scp_cmd)}")
-    print(f"{' '.join(ssh_cmd)}")
+        print(f"{' '.join(rsync_cmd)}")
+        print(f"{' '.join(ssh_cmd)}")
 
-    subprocess.run(scp_cmd, check=True)
-    subprocess.run(ssh_cmd, check=True)
+        subprocess.run(rsync_cmd, check=True)
+        subprocess.run(ssh_cmd, check=True)
 
 
 def main():
@@ -46,7 +70,7 @@ def main():
                         help="The path on the remote server to upload the files to",
                         required=True)
 
-    upload_docs_using_sftp(parser.parse_args())
+    upload_docs_using_rsync(parser.parse_args())
 
 
 if __name__ == '__main__':